@@ -1,10 +1,14 @@
 import os
 import joblib
+import hashlib
+import asyncio
 import logging
-from typing import Optional
+import functools
+import threading
+from typing import Dict, List, Optional
 
 import numpy as np
-import pandas as pd
+from fast_histogram import histogram1d
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -16,6 +20,10 @@ MODEL_PATH = os.path.join(MODEL_DIR, "model_v2.pkl")
 FEATURES_PATH = os.path.join(MODEL_DIR, "feature_columns.pkl")
 CITIES_PATH = os.path.join(MODEL_DIR, "city_categories.pkl")
 
+# XGBoost and Treelite compare splits in float32, so feeding float32 rows is
+# exact and skips a conversion copy; every feature matrix uses this dtype
+FEATURE_DTYPE = np.float32
+
 logger = logging.getLogger("uvicorn.error")
 
 try:
@@ -26,6 +34,54 @@ except Exception as e:
     logger.exception("Failed to load model or metadata")
     raise RuntimeError(f"Failed to load model or metadata: {e}")
 
+
+def load_predictor():
+    """Compile final_model with Treelite into a shared library (once per model
+    file and Treelite version) and return its predict function; fall back to
+    final_model.predict."""
+    try:
+        import treelite
+        import tl2cgen
+
+        # key the library on the pickle's content and the compiler versions, so a
+        # swapped model or a treelite/tl2cgen upgrade always gets a fresh build
+        digest = hashlib.sha256()
+        with open(MODEL_PATH, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        digest.update(f"{treelite.__version__}/{tl2cgen.__version__}".encode())
+        lib_path = os.path.join(MODEL_DIR, f"model_v2.{digest.hexdigest()[:16]}.so")
+
+        if not os.path.exists(lib_path):
+            tl_model = treelite.frontend.from_xgboost(final_model.get_booster())
+            # build next to the target and swap it in so other workers never load a partial file
+            tmp_path = f"{lib_path}.{os.getpid()}.so"
+            tl2cgen.export_lib(tl_model, toolchain="gcc", libpath=tmp_path,
+                               params={"parallel_comp": os.cpu_count() or 1})
+            os.replace(tmp_path, lib_path)
+
+        predictor = tl2cgen.Predictor(lib_path, nthread=os.cpu_count())
+        if predictor.num_feature != len(feature_columns):
+            raise ValueError(f"{lib_path} expects {predictor.num_feature} features, "
+                             f"feature_columns has {len(feature_columns)}")
+    except Exception as e:
+        logger.warning(f"Compiled model unavailable ({e}), using final_model.predict")
+        return final_model.predict
+
+    # Predictor.predict may only be called by one thread at a time, and each call
+    # already fans out over all cores, so callers take turns
+    lock = threading.Lock()
+
+    def predict(X: np.ndarray) -> np.ndarray:
+        dmat = tl2cgen.DMatrix(np.asarray(X, dtype=FEATURE_DTYPE))
+        with lock:
+            return predictor.predict(dmat).reshape(-1)
+
+    return predict
+
+
+model_predict = load_predictor()
+
 TRAIN_KEYS = {
     "عدد_الغرف": "عدد الغرف",
     "عدد_الحمامات": "عدد الحمامات",
@@ -39,6 +95,30 @@ TRAIN_KEYS = {
 
 CITY_PREFIX = "المدينة_"
 
+# post-prediction price bonus for apartments with parking (not a model feature)
+PARKING_BONUS = 1.011
+
+# zero row in training column order, filled in place per request
+TEMPLATE = np.zeros((1, len(feature_columns)), dtype=FEATURE_DTYPE)
+COL_IDX = {c: i for i, c in enumerate(feature_columns)}
+# the dropped-first city has no column of its own
+CITY_COL_IDX = {c: COL_IDX.get(f"{CITY_PREFIX}{c}") for c in city_categories}
+OTHER_IDX = CITY_COL_IDX.get("أخرى")
+
+# per-thread scratch buffers reused across requests; a buffer is only valid
+# until the same thread asks for it again, so never hold one across an await
+_tls = threading.local()
+
+
+def scratch_row() -> np.ndarray:
+    row = getattr(_tls, "row", None)
+    if row is None:
+        row = _tls.row = TEMPLATE.copy()
+    else:
+        row.fill(0)
+    return row
+
+
 app = FastAPI(title="Aqariy Smart – Price Prediction")
 
 app.add_middleware(
@@ -66,46 +146,115 @@ class PredictIn(BaseModel):
     المدينة: str = Field(..., description="اسم المدينة (Arabic)")
 
 
-def map_building_age(age: int) -> int:
-    if age == 0:
-        return 0
-    elif age == 1:
-        return 1
-    elif 2 <= age <= 5:
-        return 2
-    elif 6 <= age <= 9:
-        return 3
-    elif 10 <= age <= 19:
-        return 4
-    else:
-        return 5
+# response models let FastAPI serialize straight to JSON bytes via pydantic-core
+# (numpy scalars and arrays are accepted as-is)
+class PredictOut(BaseModel):
+    predicted_price: float
+    factors: Dict[str, float]
 
 
-def build_model_input(payload: PredictIn) -> pd.DataFrame:
-    base = {
-        TRAIN_KEYS["عدد_الغرف"]: int(payload.عدد_الغرف),
-        TRAIN_KEYS["عدد_الحمامات"]: int(payload.عدد_الحمامات),
-        TRAIN_KEYS["مفروشة"]: int(payload.مفروشة),
-        TRAIN_KEYS["مساحة_البناء"]: float(payload.مساحة_البناء),
-        TRAIN_KEYS["الطابق"]: int(payload.الطابق),
-        TRAIN_KEYS["عمر_البناء"]: map_building_age(int(payload.عمر_البناء)),
-        TRAIN_KEYS["العقار_مرهون"]: int(payload.العقار_مرهون),
-        TRAIN_KEYS["طريقة_الدفع"]: int(payload.طريقة_الدفع),
-    }
+# building age (years) -> training age bucket; ages above 20 share the last entry
+AGE_LUT = np.array([0, 1, 2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 5], dtype=np.int8)
 
-    city_cols = {f"{CITY_PREFIX}{c}": 0 for c in city_categories}
 
-    if payload.المدينة in city_categories:
-        city_cols[f"{CITY_PREFIX}{payload.المدينة}"] = 1
-    else:
-        other_col = f"{CITY_PREFIX}أخرى"
-        if other_col in city_cols:
-            city_cols[other_col] = 1
+def build_model_input(payload: PredictIn) -> np.ndarray:
+    # the returned row is this thread's scratch buffer
+    row = scratch_row()
+    row[0, COL_IDX[TRAIN_KEYS["عدد_الغرف"]]] = int(payload.عدد_الغرف)
+    row[0, COL_IDX[TRAIN_KEYS["عدد_الحمامات"]]] = int(payload.عدد_الحمامات)
+    row[0, COL_IDX[TRAIN_KEYS["مفروشة"]]] = int(payload.مفروشة)
+    row[0, COL_IDX[TRAIN_KEYS["مساحة_البناء"]]] = float(payload.مساحة_البناء)
+    row[0, COL_IDX[TRAIN_KEYS["الطابق"]]] = int(payload.الطابق)
+    row[0, COL_IDX[TRAIN_KEYS["عمر_البناء"]]] = AGE_LUT[min(int(payload.عمر_البناء), 20)]
+    row[0, COL_IDX[TRAIN_KEYS["العقار_مرهون"]]] = int(payload.العقار_مرهون)
+    row[0, COL_IDX[TRAIN_KEYS["طريقة_الدفع"]]] = int(payload.طريقة_الدفع)
+
+    # unknown cities fall back to "أخرى"; a city without a column stays all-zero
+    city_idx = CITY_COL_IDX.get(payload.المدينة, OTHER_IDX)
+    if city_idx is not None:
+        row[0, city_idx] = 1
+
+    return row
+
+
+# values swept by /judge_price to build the market price distribution
+JUDGE_GRID = {
+    "عدد_الغرف": range(1, 5),
+    "عدد_الحمامات": range(1, 4),
+    "عمر_البناء": [0, 5, 9, 19, 20],
+    "الطابق": [0, 1, 2, 3, 4, 11],
+    "مفروشة": [0, 1],
+    "طريقة_الدفع": [0, 1, 2],
+    "العقار_مرهون": [0, 1],
+}
+VARIED_COL_IDX = [COL_IDX[TRAIN_KEYS[k]] for k in JUDGE_GRID]
+
+
+def build_variant_grid() -> np.ndarray:
+    axes = [
+        AGE_LUT[np.minimum(values, 20)] if key == "عمر_البناء" else list(values)
+        for key, values in JUDGE_GRID.items()
+    ]
+    grids = np.meshgrid(*axes, indexing="ij")
 
-    row = {**base, **city_cols}
-    df = pd.DataFrame([row])
-    df = df.reindex(columns=feature_columns, fill_value=0)
-    return df
+    X = np.zeros((grids[0].size, len(feature_columns)), dtype=FEATURE_DTYPE)
+    for col, grid in zip(VARIED_COL_IDX, grids):
+        X[:, col] = grid.ravel()
+    return X
+
+
+# the varied columns never depend on the request, so build them once and only
+# fill in area and city per call
+GRID_TEMPLATE = build_variant_grid()
+
+
+def scratch_grid() -> np.ndarray:
+    grid = getattr(_tls, "grid", None)
+    if grid is None:
+        grid = _tls.grid = GRID_TEMPLATE.copy()
+    else:
+        np.copyto(grid, GRID_TEMPLATE)
+    return grid
+
+
+@functools.lru_cache(maxsize=4096)
+def market_stats(city: str, area: float) -> tuple:
+    """Market price distribution for an apartment of this area in this city.
+
+    The grid sweeps every other feature, so the result depends on (city, area)
+    only and is cached as plain Python scalars.
+    """
+    X = scratch_grid()
+    X[:, COL_IDX[TRAIN_KEYS["مساحة_البناء"]]] = area
+    city_idx = CITY_COL_IDX.get(city, OTHER_IDX)
+    if city_idx is not None:
+        X[:, city_idx] = 1
+
+    # predict every combination of the varied features to get the market range
+    # summary stats in float64 so the mean of ~4.6k prices keeps its cents
+    predicted_prices = model_predict(X).astype(float)
+
+    # one partial sort places min, max and the order statistics the quartiles
+    # interpolate between (same linear method as np.percentile)
+    n = predicted_prices.size
+    pos = np.array([0.25, 0.5, 0.75]) * (n - 1)
+    lo, hi = np.floor(pos).astype(int), np.ceil(pos).astype(int)
+    part = np.partition(predicted_prices, np.unique([0, n - 1, *lo, *hi]))
+
+    price_min = float(part[0])
+    price_max = float(part[n - 1])
+    price_mean = float(predicted_prices.mean())
+    price_q1, price_median, price_q3 = (part[lo] + (part[hi] - part[lo]) * (pos - lo)).tolist()
+
+    # regular bins over [min, max] like np.histogram; histogram1d's last bin is
+    # half-open, so the samples sitting on the max are added back by hand
+    lo, hi = (price_min - 0.5, price_max + 0.5) if price_min == price_max else (price_min, price_max)
+    hist_counts = histogram1d(predicted_prices, bins=10, range=(lo, hi)).astype(int)
+    hist_counts[-1] += np.count_nonzero(predicted_prices == hi)
+    hist_edges = np.linspace(lo, hi, 11)
+
+    return (price_min, price_mean, price_median, price_q1, price_q3, price_max,
+            tuple(hist_counts.tolist()), tuple(hist_edges.tolist()))
 
 import shap
 
@@ -120,47 +269,68 @@ FEATURE_GROUPS = {
     "المدينة": [col for col in feature_columns if col.startswith(CITY_PREFIX)],
 }
 
-def group_shap_values(shap_values: np.ndarray, input_df: pd.DataFrame):
-    feature_shap = dict(zip(input_df.columns, shap_values))
-    grouped = {}
+GROUP_NAMES = list(FEATURE_GROUPS)
+# (n_groups, n_features) 0/1 membership, so grouping is one matmul
+GROUP_MATRIX = np.zeros((len(FEATURE_GROUPS), len(feature_columns)), dtype=FEATURE_DTYPE)
+for g, features in enumerate(FEATURE_GROUPS.values()):
+    for f in features:
+        if f in COL_IDX:
+            GROUP_MATRIX[g, COL_IDX[f]] = 1
+CITY_COLS = np.array([COL_IDX[f] for f in FEATURE_GROUPS["المدينة"]], dtype=int)
 
-    for group_name, features in FEATURE_GROUPS.items():
-        if group_name == "المدينة":
-            # sum only the active city column (value=1 in input_df)
-            active_cities = [f for f in features if input_df.iloc[0][f] == 1]
-            grouped[group_name] = sum(feature_shap.get(f, 0) for f in active_cities)
-        else:
-            grouped[group_name] = sum(feature_shap.get(f, 0) for f in features)
 
-    total_abs = sum(abs(v) for v in grouped.values()) or 1e-9
-    ranked = {k: round((v / total_abs) * 100, 2) for k, v in grouped.items()}
+def group_shap_values(shap_values: np.ndarray, input_row: np.ndarray):
+    contribs = shap_values.copy()
+    # sum only the active city column (value=1 in input_row)
+    contribs[CITY_COLS] *= input_row[0, CITY_COLS]
+    grouped = GROUP_MATRIX @ contribs
 
-    # sort by absolute value descending
-    ranked = dict(sorted(ranked.items(), key=lambda x: abs(x[1]), reverse=True))
+    total_abs = np.abs(grouped).sum() or 1e-9
+    ranked = np.round((grouped / total_abs) * 100, 2)
 
-    # keep only top 4
-    top_ranked = dict(list(ranked.items())[:4])
-    return top_ranked
+    # top 4 by absolute value; stable so ties keep FEATURE_GROUPS order
+    top = np.argsort(-np.abs(ranked), kind="stable")[:4]
+    return {GROUP_NAMES[i]: ranked[i] for i in top}
 
 
-@app.post("/predict")
-def predict(payload: PredictIn):
-    try:
-        df_input = build_model_input(payload)
-        y_pred = final_model.predict(df_input)[0]
+def compile_inference():
+    """Resolve the model, explainer and helpers once and return a
+    predict_one(payload) -> (price, factors) closure over local names."""
+    _predict = model_predict
+    _shap = explainer.shap_values
+    _build = build_model_input
+    _group = group_shap_values
+    _parking_bonus = PARKING_BONUS
 
-        if payload.موقف_سيارات:
-            y_pred *= 1.011
+    def predict_one(payload: PredictIn):
+        X = _build(payload)
+        y_pred = _predict(X)[0] * (_parking_bonus if payload.موقف_سيارات else 1.0)
+        # plain (1, F) array, no Explanation object
+        contribs = _shap(X, check_additivity=False)[0]
+        return y_pred, _group(contribs, X)
 
-        shap_values = explainer(df_input)
-        contribs = shap_values.values[0]
+    return predict_one
 
-        grouped = group_shap_values(contribs, df_input)
-        # ensure all values are native floats
-        grouped = {k: float(round(v, 2)) for k, v in grouped.items()}
+
+app.state.predict_one = compile_inference()
+
+# pay shap's lazy setup and the predictor's thread pool start-up at import
+# instead of on the first requests
+app.state.predict_one(PredictIn(
+    عدد_الغرف=1, عدد_الحمامات=1, مفروشة=0, مساحة_البناء=100, الطابق=0,
+    عمر_البناء=0, العقار_مرهون=0, طريقة_الدفع=0, المدينة=city_categories[0],
+))
+model_predict(GRID_TEMPLATE)
+
+
+@app.post("/predict")
+async def predict(payload: PredictIn) -> PredictOut:
+    try:
+        # model and shap release the GIL, so run them off the event loop
+        y_pred, grouped = await asyncio.to_thread(app.state.predict_one, payload)
 
         return {
-            "predicted_price": float(np.round(y_pred, 2)),
+            "predicted_price": np.round(y_pred, 2),
             "factors": grouped,
         }
     except Exception as e:
@@ -185,85 +355,88 @@ def root():
 
 
 
+# one key per rule of judge_listed_price, in the same order
+JUDGMENT_KEYS = (
+    "SUSPICIOUSLY_UNDERPRICED",
+    "FAIR_LOW",
+    "PREDICTED_PRICE",
+    "GOOD_DEAL",
+    "PREDICTED_PRICE",
+    "FAIR_PRICE",
+    "OVERPRICED",
+)
+
+
+def judge_listed_price(listed: float, predicted_price: float,
+                       price_min: float, price_mean: float, price_max: float) -> str:
+    # the bands overlap (the predicted-price band can sit on either side of the
+    # mean-based cuts), so the first rule that holds wins
+    rules = (
+        listed < max(price_min * 0.9, price_mean * 0.7),
+        listed < price_mean * 0.85,
+        predicted_price * 0.95 <= listed <= predicted_price * 1.05,
+        listed < price_mean * 0.95,
+        listed < predicted_price,
+        listed <= price_max,
+        True,
+    )
+    return JUDGMENT_KEYS[rules.index(True)]
+
+
 class JudgeIn(PredictIn):
     listed_price: confloat(gt=0) = Field(..., description="السعر المعروض من المستخدم")
+
+
+class HistOut(BaseModel):
+    counts: List[int]
+    edges: List[float]
+
+
+class JudgeOut(BaseModel):
+    judgment_key: str
+    listed_price: float
+    predicted_price: float
+    market_mean: float
+    market_median: float
+    price_q1: float
+    price_q3: float
+    price_range: List[float]
+    hist: HistOut
+
+
+def judge_inputs(payload: JudgeIn):
+    """Market stats (cached per city and area) and the parking-adjusted
+    predicted price for one judgment."""
+    stats = market_stats(payload.المدينة, float(payload.مساحة_البناء))
+    park_scale = PARKING_BONUS if payload.موقف_سيارات else 1.0
+    predicted_price = float(model_predict(build_model_input(payload))[0]) * park_scale
+    return stats, predicted_price
+
+
 @app.post("/judge_price")
-def judge_price(payload: JudgeIn):
+async def judge_price(payload: JudgeIn) -> JudgeOut:
     try:
-        variants = []
-        # loop over all combinations to get the market range
-        for rooms in range(1, 5):
-            for baths in range(1, 4):
-                for age in [0, 5, 9, 19, 20]:
-                    for floor in [0, 1, 2, 3, 4, 11]:
-                        for furnished in [0, 1]:
-                            for payment in [0, 1, 2]:
-                                for mortgaged in [0, 1]:
-                                    variant = payload.model_copy(deep=True)
-                                    variant.عدد_الغرف = rooms
-                                    variant.عدد_الحمامات = baths
-                                    variant.عمر_البناء = age
-                                    variant.الطابق = floor
-                                    variant.مفروشة = furnished
-                                    variant.طريقة_الدفع = payment
-                                    variant.العقار_مرهون = mortgaged
-                                    variants.append(build_model_input(variant))
-
-        all_df = pd.concat(variants, ignore_index=True)
-        predicted_prices = final_model.predict(all_df).astype(float)
-
-        price_min = float(np.min(predicted_prices))
-        price_max = float(np.max(predicted_prices))
-        price_mean = float(np.mean(predicted_prices))
-        price_median = float(np.median(predicted_prices))
-        price_q1 = float(np.percentile(predicted_prices, 25))
-        price_q3 = float(np.percentile(predicted_prices, 75))
-
-        hist_counts, hist_edges = np.histogram(predicted_prices, bins=10)
-        hist_counts = hist_counts.tolist()
-        hist_edges = hist_edges.tolist()
+        # both model calls run in one worker-thread hop, off the event loop
+        stats, predicted_price = await asyncio.to_thread(judge_inputs, payload)
+        (price_min, price_mean, price_median, price_q1, price_q3, price_max,
+         hist_counts, hist_edges) = stats
 
         listed = float(payload.listed_price)
 
-        df_input = build_model_input(payload)
-        predicted_price = float(final_model.predict(df_input)[0])
-
-        if payload.موقف_سيارات:
-            predicted_price *= 1.011
-
-        if listed < max(price_min * 0.9, price_mean * 0.7):
-            judgment_key = "SUSPICIOUSLY_UNDERPRICED"
-        elif listed < price_mean * 0.85:
-            judgment_key = "FAIR_LOW"
-        elif predicted_price * 0.95 <= listed <= predicted_price * 1.05:
-            judgment_key = "PREDICTED_PRICE"
-        elif listed < price_mean * 0.95:
-            judgment_key = "GOOD_DEAL"
-        elif listed < predicted_price:
-            judgment_key = "PREDICTED_PRICE"
-        elif listed <= price_max:
-            judgment_key = "FAIR_PRICE"
-        else:
-            judgment_key = "OVERPRICED"
-
-        def r(x): 
-            try:
-                return float(round(x, 2))
-            except Exception:
-                return x
+        judgment_key = judge_listed_price(listed, predicted_price, price_min, price_mean, price_max)
 
         return {
             "judgment_key": judgment_key,
-            "listed_price": r(listed),
-            "predicted_price": r(predicted_price),         
-            "market_mean": r(price_mean),
-            "market_median": r(price_median),
-            "price_q1": r(price_q1),
-            "price_q3": r(price_q3),
-            "price_range": [r(price_min), r(price_max)],
+            "listed_price": round(listed, 2),
+            "predicted_price": round(predicted_price, 2),
+            "market_mean": round(price_mean, 2),
+            "market_median": round(price_median, 2),
+            "price_q1": round(price_q1, 2),
+            "price_q3": round(price_q3, 2),
+            "price_range": [round(price_min, 2), round(price_max, 2)],
             "hist": {
-                "counts": hist_counts,   
-                "edges": hist_edges      
+                "counts": hist_counts,
+                "edges": hist_edges
             }
         }
 
@@ -1,42 +1,67 @@
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
+import httpx
+import asyncio
+import ahocorasick
 import pandas as pd
 import time
 import re
 
 eastern_to_western_map = str.maketrans('٠١٢٣٤٥٦٧٨٩', '0123456789')
 
+_DIGITS = re.compile(r'\d+')
+_PRICE_RE = re.compile(r'([\d,]+)\s*شيكل')
+
+FLOOR_MAP = {
+    'ارضي': 'G', 'الأرضي': 'G', 'روف': 'R', 'أخير': 'R',
+    'تسوية': 'B', 'سفلي': 'B', 'بيسمنت': 'B', 'مواقف': 'P'
+}
+FLOOR_NUMBER_MAP = {
+    'الأول': 1, 'الثاني': 2, 'الثالث': 3, 'الرابع': 4, 'الخامس': 5,
+    'السادس': 6, 'السابع': 7, 'الثامن': 8, 'التاسع': 9, 'العاشر': 10
+}
+AGE_MAP = {
+    "جديد": 0, "قيد الإنشاء": 0, "0 - 11 شهر": 1,
+    "1 - 5 سنوات": 2, "6 - 9 سنوات": 3, "10 - 19 سنوات": 4, "20+ سنة": 5
+}
+PAYMENT_MAP = {
+    "كاش": 0, "تقسيط": 1, "اقساط": 1,
+    "كاش أو أقساط": 2, "كاش واقساط": 2
+}
+FURNISHED_MAP = {
+    "غير مفروشة": 0, "مفروشة": 1, "مفروش جزئياً": 2
+}
+
+# all floor keywords in one automaton; ranking matches by their position in
+# FLOOR_MAP then FLOOR_NUMBER_MAP keeps the old first-key-wins order
+FLOOR_AUTOMATON = ahocorasick.Automaton()
+for rank, (key, value) in enumerate([*FLOOR_MAP.items(), *FLOOR_NUMBER_MAP.items()]):
+    FLOOR_AUTOMATON.add_word(key, (rank, value))
+FLOOR_AUTOMATON.make_automaton()
+
+def to_western_digits(text):
+    return text.translate(eastern_to_western_map) if text else text
+
+# price/floor/rooms/age/area transforms expect text already passed through to_western_digits
+
 def transform_price(price_text):
     if not price_text: return None
-    price_text = price_text.translate(eastern_to_western_map)
-    m = re.search(r"([\d,]+)\s*شيكل", price_text)
+    m = _PRICE_RE.search(price_text)
     return m.group(1) if m else None
 
 def transform_floor(floor_text):
     if not floor_text: return None
-    floor_text = floor_text.translate(eastern_to_western_map)
-    floor_map = {
-        'ارضي': 'G', 'الأرضي': 'G', 'روف': 'R', 'أخير': 'R',
-        'تسوية': 'B', 'سفلي': 'B', 'بيسمنت': 'B', 'مواقف': 'P'
-    }
-    for key, value in floor_map.items():
-        if key in floor_text: return value
-    number_map = {
-        'الأول': 1, 'الثاني': 2, 'الثالث': 3, 'الرابع': 4, 'الخامس': 5,
-        'السادس': 6, 'السابع': 7, 'الثامن': 8, 'التاسع': 9, 'العاشر': 10
-    }
-    for key, value in number_map.items():
-        if key in floor_text: return value
-    digits = re.search(r'\d+', floor_text)
+    matches = [match for _, match in FLOOR_AUTOMATON.iter(floor_text)]
+    if matches: return min(matches)[1]
+    digits = _DIGITS.search(floor_text)
     if digits: return int(digits.group(0))
     return floor_text
 
 def transform_rooms_bathrooms(text):
     if not text: return None
-    western_text = text.translate(eastern_to_western_map)
-    digits = re.search(r'\d+', western_text)
+    digits = _DIGITS.search(text)
     if digits:
         return int(digits.group(0))
     if "حمامين" in text or "غرفتين" in text: return 2
@@ -46,14 +71,9 @@ def transform_rooms_bathrooms(text):
 
 def transform_age(age_text):
     if not age_text: return None
-    age_text = age_text.translate(eastern_to_western_map)
-    age_map = {
-        "جديد": 0, "قيد الإنشاء": 0, "0 - 11 شهر": 1,
-        "1 - 5 سنوات": 2, "6 - 9 سنوات": 3, "10 - 19 سنوات": 4, "20+ سنة": 5
-    }
-    if age_text in age_map:
-        return age_map[age_text]
-    digits = re.search(r'\d+', age_text)
+    if age_text in AGE_MAP:
+        return AGE_MAP[age_text]
+    digits = _DIGITS.search(age_text)
     if digits:
         num_age = int(digits.group(0))
         if num_age == 0: return 0
@@ -64,103 +84,153 @@ def transform_age(age_text):
         if num_age in [0, 1, 2, 3, 4, 5]: return num_age
     return age_text
 
+def transform_area(area_text):
+    if not area_text: return None
+    digits = _DIGITS.search(area_text)
+    return digits.group(0) if digits else None
+
 def transform_payment(payment_text):
     if not payment_text: return 0
-    payment_map = {
-        "كاش": 0, "تقسيط": 1, "اقساط": 1,
-        "كاش أو أقساط": 2, "كاش واقساط": 2
-    }
-    return payment_map.get(payment_text, 0)
+    return PAYMENT_MAP.get(payment_text, 0)
 
 def transform_furnished(furnished_text):
     if not furnished_text: return 0
-    furnished_map = {
-        "غير مفروشة": 0, "مفروشة": 1, "مفروش جزئياً": 2
-    }
-    return furnished_map.get(furnished_text, 0)
+    return FURNISHED_MAP.get(furnished_text, 0)
 
 def transform_mortgaged(mortgaged_text):
     if not mortgaged_text: return 'F'
     return 'F' if mortgaged_text == "لا" else 'T'
 
-# --- Main Scraper ---
-options = Options()
-options.add_argument("--headless")
-options.add_argument("--disable-gpu")
-options.add_argument("--no-sandbox")
-driver = webdriver.Chrome(service=Service(), options=options)
-
-base_list_url = "https://ps.opensooq.com/ar/%D8%B9%D9%82%D8%A7%D8%B1%D8%A7%D8%AA/%D8%B4%D9%82%D9%82-%D9%84%D9%84%D8%A8%D9%8A%D8%B9?sort_code=recent&page="
-base_site = "https://ps.opensooq.com"
+INFO_LABEL_MAP = {
+    "المدينة": "city", "الحي / المنطقة": "neighborhood", "عدد الغرف": "num_rooms",
+    "عدد الحمامات": "num_bathrooms", "مفروشة؟": "furnished",
+    "مساحة البناء": "area", "الطابق": "floor", "عمر البناء": "age",
+    "هل العقار مرهون": "mortgaged", "طريقة الدفع": "payment", "المزايا": "extras"
+}
 
-pages_num = 4  # Set the number of pages to scrape
-apts_data = []
-
-for page in range(1, pages_num + 1):
-    print(f"Loading listing page {page}")
-    driver.get(f"{base_list_url}{page}")
-    time.sleep(3)
-    soup = BeautifulSoup(driver.page_source, "html.parser")
-    cards = soup.select("a.postListItemData")
-    print(f"Found {len(cards)} cards on page {page}")
-    
+def parse_listing(html):
+    cards = LexborHTMLParser(html).css("a.postListItemData")
+    listing = []
     for c in cards:
-        price_element = c.select_one("div.priceColor")
-        apts_data.append({
-            "price_raw": price_element.getText(strip=True) if price_element else None,
-            "details_url": base_site + c["href"]
+        price_element = c.css_first("div.priceColor")
+        listing.append({
+            "price_raw": price_element.text(strip=True) if price_element else None,
+            "details_url": base_site + c.attributes["href"]
         })
-
-full_data = []
-for apt in apts_data:
-    if not apt.get("details_url"): continue
-    driver.get(apt["details_url"])
-    print(f"Scraping {apt['details_url']}...")
-    time.sleep(3)
-    details_soup = BeautifulSoup(driver.page_source, "html.parser")
-    info_ul = details_soup.select_one("section#PostViewInformation ul.flex.flexSpaceBetween.flexWrap.mt-8")
-    
-    raw_info = {
-        "city": None, "neighborhood": None, "num_rooms": None, "num_bathrooms": None,
-        "furnished": None, "area": None, "floor": None, "age": None,
-        "mortgaged": None, "payment": None, "extras": None
-    }
-    
-    if info_ul:
-        for li in info_ul.select("li"):
-            label_el = li.select_one("p")
-            if not label_el: continue
-            label = label_el.get_text(strip=True)
-            value_el = label_el.find_next_sibling(["a", "span"])
-            if not value_el: continue
-            value = value_el.get_text(strip=True)
-            label_map = {
-                "المدينة": "city", "الحي / المنطقة": "neighborhood", "عدد الغرف": "num_rooms",
-                "عدد الحمامات": "num_bathrooms", "مفروشة؟": "furnished",
-                "مساحة البناء": "area", "الطابق": "floor", "عمر البناء": "age",
-                "هل العقار مرهون": "mortgaged", "طريقة الدفع": "payment", "المزايا": "extras"
-            }
-            if label in label_map:
-                raw_info[label_map[label]] = value
-
-    processed_apt = {
-        'price': transform_price(apt['price_raw']),
+    return listing
+
+def parse_details(html):
+    """Return the raw info fields of a details page, or None if the info list is missing."""
+    info_ul = LexborHTMLParser(html).css_first("section#PostViewInformation ul.flex.flexSpaceBetween.flexWrap.mt-8")
+    if info_ul is None: return None
+
+    raw_info = dict.fromkeys(INFO_LABEL_MAP.values())
+    for li in info_ul.css("li"):
+        label_el = li.css_first("p")
+        if not label_el: continue
+        label = label_el.text(strip=True)
+        # first <a>/<span> sibling after the label, skipping text nodes
+        value_el = label_el.next
+        while value_el is not None and value_el.tag not in ("a", "span"):
+            value_el = value_el.next
+        if not value_el: continue
+        if label in INFO_LABEL_MAP:
+            raw_info[INFO_LABEL_MAP[label]] = value_el.text(strip=True)
+    return raw_info
+
+def process_apt(apt, raw_info):
+    # translate the digits of every numeric field once per record
+    numeric = {k: to_western_digits(raw_info[k]) for k in ('num_rooms', 'num_bathrooms', 'area', 'floor', 'age')}
+    return {
+        'price': transform_price(to_western_digits(apt['price_raw'])),
         'city': raw_info['city'],
         'neighborhood': raw_info['neighborhood'],
-        'num_rooms': transform_rooms_bathrooms(raw_info['num_rooms']),
-        'num_bathrooms': transform_rooms_bathrooms(raw_info['num_bathrooms']),
+        'num_rooms': transform_rooms_bathrooms(numeric['num_rooms']),
+        'num_bathrooms': transform_rooms_bathrooms(numeric['num_bathrooms']),
         'furnished': transform_furnished(raw_info['furnished']),
-        'area': re.search(r'\d+', raw_info['area'].translate(eastern_to_western_map)).group(0) if raw_info['area'] and re.search(r'\d+', raw_info['area'].translate(eastern_to_western_map)) else None,
-        'floor': transform_floor(raw_info['floor']),
-        'age': transform_age(raw_info['age']),
+        'area': transform_area(numeric['area']),
+        'floor': transform_floor(numeric['floor']),
+        'age': transform_age(numeric['age']),
         'mortgaged': transform_mortgaged(raw_info['mortgaged']),
         'payment': transform_payment(raw_info['payment']),
         'elevator': 'T' if raw_info['extras'] and 'مصعد' in raw_info['extras'] else 'F',
         'parking': 'T' if raw_info['extras'] and 'موقف سيارات' in raw_info['extras'] else 'F'
     }
-    full_data.append(processed_apt)
 
-driver.quit()
+async def fetch(client, sem, url):
+    async with sem:
+        try:
+            response = await client.get(url)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            print(f"Failed to fetch {url}: {e}")
+            return None
+        return response.text
+
+def render_with_selenium(urls):
+    """Render pages whose content is built client-side with headless Chrome."""
+    if not urls: return {}
+    options = Options()
+    options.add_argument("--headless")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--no-sandbox")
+    driver = webdriver.Chrome(service=Service(), options=options)
+    pages = {}
+    try:
+        for url in urls:
+            print(f"Rendering {url} with Selenium...")
+            driver.get(url)
+            time.sleep(3)
+            pages[url] = driver.page_source
+    finally:
+        driver.quit()
+    return pages
+
+async def scrape(pages_num):
+    sem = asyncio.Semaphore(CONCURRENCY)
+    async with httpx.AsyncClient(http2=True, headers=HEADERS, follow_redirects=True, timeout=30) as client:
+        list_urls = [f"{base_list_url}{page}" for page in range(1, pages_num + 1)]
+        print(f"Loading {len(list_urls)} listing pages")
+        list_pages = await asyncio.gather(*[fetch(client, sem, u) for u in list_urls])
+
+        # listing pages with no server-rendered cards go through the browser
+        listings = {u: parse_listing(html) if html else [] for u, html in zip(list_urls, list_pages)}
+        for u, html in render_with_selenium([u for u, cards in listings.items() if not cards]).items():
+            listings[u] = parse_listing(html)
+
+        apts_data = []
+        for page, u in enumerate(list_urls, start=1):
+            print(f"Found {len(listings[u])} cards on page {page}")
+            apts_data.extend(listings[u])
+
+        apts_data = [apt for apt in apts_data if apt.get("details_url")]
+        print(f"Scraping {len(apts_data)} details pages...")
+        detail_pages = await asyncio.gather(*[fetch(client, sem, apt["details_url"]) for apt in apts_data])
+
+    infos = [parse_details(html) if html else None for html in detail_pages]
+    missing = [apt["details_url"] for apt, info in zip(apts_data, infos) if info is None]
+    rendered = render_with_selenium(missing)
+
+    full_data = []
+    for apt, raw_info in zip(apts_data, infos):
+        if raw_info is None and apt["details_url"] in rendered:
+            raw_info = parse_details(rendered[apt["details_url"]])
+        if raw_info is None:
+            raw_info = dict.fromkeys(INFO_LABEL_MAP.values())
+        full_data.append(process_apt(apt, raw_info))
+    return full_data
+
+# --- Main Scraper ---
+base_list_url = "https://ps.opensooq.com/ar/%D8%B9%D9%82%D8%A7%D8%B1%D8%A7%D8%AA/%D8%B4%D9%82%D9%82-%D9%84%D9%84%D8%A8%D9%8A%D8%B9?sort_code=recent&page="
+base_site = "https://ps.opensooq.com"
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+    "Accept-Language": "ar,en;q=0.8",
+}
+CONCURRENCY = 16  # max requests in flight
+
+pages_num = 4  # Set the number of pages to scrape
+full_data = asyncio.run(scrape(pages_num))
 
 if full_data:
     df = pd.DataFrame(full_data)